@@ -49,13 +49,13 @@ def main():
         msg = "output file '{}' exists, use -O to overwrite it"
         raise OSError(msg.format(args.output))
 
-    hdulist = fits.open(args.input)
-    images = hdulist[args.hdu].data
+    with fits.open(args.input) as hdulist:
+        images = hdulist[args.hdu].data
 
-    aligned_images = alignment.register_stars(images)
+        aligned_images = alignment.register_stars(images)
 
-    hdulist[args.hdu].data = aligned_images
-    hdulist.writeto(args.output, overwrite=args.overwrite)
+        hdulist[args.hdu].data = aligned_images
+        hdulist.writeto(args.output, overwrite=args.overwrite)
 
 if __name__ == '__main__':
     main()
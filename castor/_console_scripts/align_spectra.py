@@ -58,17 +58,27 @@ def main():
             msg = "output file '{}' exists, use -O to overwrite it"
             raise OSError(msg.format(args.output))
     
-    hdulist = fits.open(args.sci_cube_rotated)
-    cube = hdulist[0].data
+    with fits.open(args.sci_cube_rotated, memmap=True) as hdulist:
+        cube = hdulist[0].data
 
-    if args.gaussian_convolve:
-        print('Using 2D gaussian, with sigma={:.2f}'.format(args.gaussian_sigma))
-    cube_aligned = spectroscopy.align_images(cube, args.hdu, xaxis=False, yaxis=True,
-                                             gauss=args.gaussian_convolve,
-                                             sigma=args.gaussian_sigma)
+        # once align_images knows the aligned cube dimensions, create the
+        # output FITS with that shape and hand its memory-mapped data back,
+        # so that aligned frames are streamed to disk instead of being held
+        # in RAM
+        out_hdulist = []
+        def allocate_output(shape):
+            hdulist[args.hdu].data = np.zeros(shape, dtype=cube.dtype)
+            hdulist.writeto(args.output, overwrite=args.overwrite)
+            out_hdulist.append(fits.open(args.output, mode='update', memmap=True))
+            return out_hdulist[0][args.hdu].data
 
-    hdulist[args.hdu].data = cube_aligned
-    hdulist.writeto(args.output, overwrite=args.overwrite)
+        if args.gaussian_convolve:
+            print('Using 2D gaussian, with sigma={:.2f}'.format(args.gaussian_sigma))
+        spectroscopy.align_images(cube, args.hdu, xaxis=False, yaxis=True,
+                                  gauss=args.gaussian_convolve,
+                                  sigma=args.gaussian_sigma,
+                                  allocate=allocate_output)
+        out_hdulist[0].close()
 
 if __name__ == '__main__':
     main()
@@ -412,11 +412,6 @@ def running_average_kernel(name, width):
         }
     return kernels[name]
 
-@np.vectorize
-def total_seconds(timedelta):
-    ''' Vectorised version of timedelta.total_seconds() '''
-    return timedelta.total_seconds()
-
 def weighted_running_average(arr, weight_func, x=None):
     ''' Compute a running average on arr, weighting the contribution of each
     term with weight-function.
@@ -552,7 +547,7 @@ def main():
     # relative times
     t_abs = timestamps
     t_ref = t_abs[0]
-    t_rel = total_seconds(t_abs - t_ref)
+    t_rel = (t_abs - t_ref) / np.timedelta64(1, 's')
     t_unit = 's'
 
     # apply a running average to the data
@@ -579,7 +574,7 @@ def main():
                  horizontalalignment='left', verticalalignment='center')
     fmt = mpl.dates.DateFormatter('%H:%M')
     plt.gca().xaxis.set_major_formatter(fmt)
-    plt.xlabel('Time on {}'.format(t_ref.date()))
+    plt.xlabel('Time on {}'.format(t_ref.item().date()))
     plt.ylabel('Normalized intensity')
     plt.ylim(.5, len(intensities.T) + .5)
     plt.title('Light curves normalized to their averages', fontsize='small')
@@ -609,7 +604,7 @@ def main():
             )
     fmt = mpl.dates.DateFormatter('%H:%M')
     plt.gca().xaxis.set_major_formatter(fmt)
-    plt.xlabel('Time on {}'.format(t_ref.date()))
+    plt.xlabel('Time on {}'.format(t_ref.item().date()))
     plt.ylabel('Relative intensity')
     plt.ylim(.5, len(intensities.T) + .5)
     plt.title('Light curves relative to other reference stars', fontsize='small')
@@ -621,7 +616,7 @@ def main():
     plt.plot_date(t_abs, rel_intensity_exo, ',')
     fmt = mpl.dates.DateFormatter('%H:%M')
     plt.gca().xaxis.set_major_formatter(fmt)
-    plt.xlabel('Time on {}'.format(t_ref.date()))
+    plt.xlabel('Time on {}'.format(t_ref.item().date()))
     plt.ylabel('Relative intensity')
     plt.ylim(.9, 1.1)
     plt.title(args.name)
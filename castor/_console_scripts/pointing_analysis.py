@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
 import os
+import sys
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 from astropy import units as u
 from astropy.io import fits
@@ -11,6 +14,10 @@ import astroalign
 import numpy as np
 import skimage.transform as skt
 import yaml
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 from castor import files_handling, preparation, alignment, photometry
 
@@ -47,6 +54,11 @@ def get_parsed_args():
         help=('Source extraction threshold, passed to sep.extract(). '
               'https://sep.readthedocs.io/en/latest/api/sep.extract.html '
               'Default: 5'))
+    parser.add_argument(
+        '--rebin', type=int, default=1,
+        help=('Rebin images by this factor before extracting sources, '
+              'speeding up source extraction at the cost of centroid '
+              'accuracy. Default: 1 (no rebinning)'))
     parser.add_argument(
         '--ref-image', type=int, default=0,
         help=('Indice of the image used as a reference to determine '
@@ -72,6 +84,53 @@ def get_parsed_args():
 
     return args
 
+# astroalign.find_transform keeps at most this many control points, by
+# truncating the end of the list it is given
+MAX_CONTROL_POINTS = 50
+
+def _rebinned_sources_coordinates(img, threshold, rebin):
+    ''' Extract source coordinates on a rebinned image, scaled back to
+    full-resolution pixels.
+
+    Only the MAX_CONTROL_POINTS brightest sources are returned (brightest
+    first), pruning the candidate set fed to the triangle matching in
+    astroalign.find_transform, which would otherwise keep the faint end
+    of the flux-sorted list.
+    '''
+    sources = photometry.sep_sources_coordinates(
+        photometry.rebin(img, rebin), threshold=threshold)
+    # sep_extract sorts by increasing flux: brightest sources are last
+    sources = sources[::-1][:MAX_CONTROL_POINTS]
+    if rebin != 1:
+        # pixel centers map to (x + 1/2) × rebin - 1/2 in the full image
+        sources = (sources + .5) * rebin - .5
+    return sources
+
+# per-run constants of the transform fit, set once per worker process by
+# _init_worker instead of being pickled with every task
+_worker_state = {}
+
+def _init_worker(ref_sources, threshold, rebin):
+    _worker_state['ref_sources'] = ref_sources
+    _worker_state['threshold'] = threshold
+    _worker_state['rebin'] = rebin
+
+def _fit_one_worker(img):
+    return _fit_one(img, **_worker_state)
+
+def _fit_one(img, ref_sources, threshold, rebin=1):
+    ''' Extract the sources of an image and fit the transform to reference
+    sources. Ran in worker processes; returns a NaN transform on failure so
+    that downstream scale/rotation/translation arrays keep their shape. '''
+    try:
+        sources = _rebinned_sources_coordinates(img, threshold, rebin)
+        p, _ = astroalign.find_transform(sources, ref_sources)
+    except Exception as e:
+        warnings.warn(str(e))
+        p = skt.SimilarityTransform(
+            scale=np.nan, rotation=np.nan, translation=np.nan)
+    return p
+
 def find_transform(sources_1, sources_2):
     try:
         p, _ = astroalign.find_affine_transform(sources_1, sources_2)
@@ -86,15 +145,16 @@ def main():
 
     # Instruments properties
     with open(files_handling.get_package_data('instruments.yml')) as f:
-        instruments = yaml.load(f)
+        instruments = yaml.load(f, Loader=YamlLoader)
     focale = u.Quantity(instruments['telescopes'][args.telescope]['focale length'])
     px_size = instruments['cameras'][args.camera]['pixel size']
     px_size = u.Quantity([u.Quantity(s.replace('µm', 'um')) for s in px_size])
 
     # Data properties
     sample_fits = os.path.join(args.sample_track_fits)
-    hdu = fits.open(sample_fits)[0]
-    binning = np.array((hdu.header['XBINNING'], hdu.header['YBINNING']))
+    # getheader opens and closes the file internally, and skips the data
+    header = fits.getheader(sample_fits)
+    binning = np.array((header['XBINNING'], header['YBINNING']))
     binned_px_size = px_size * binning
     px_angular_size = np.arctan(binned_px_size / focale).to('arcsec')
 
@@ -110,27 +170,54 @@ def main():
     # Align images ------------------------------------------------------------
 
     # Align using a reference image
-    ref_img = images[args.ref_image]
-    ref_sources = photometry.sep_sources_coordinates(ref_img, threshold=args.sep_threshold)
-    if len(ref_sources) < 3:
-        raise Exception('Reference stars in target image are less than the '
-                        'minimum value (3).')
-    iterable = tqdm(images, desc='Aligning images', total=len(images))
-    transforms = []
-    for i, img in enumerate(iterable):
-        try:
-            sources = photometry.sep_sources_coordinates(img, threshold=args.sep_threshold)
-            p, _ = astroalign.find_transform(sources, ref_sources)
-        except Exception as e:
-            warnings.warn('Image {}: {}'.format(i, e))
-            p = skt.SimilarityTransform(
-                scale=np.nan, rotation=np.nan, translation=np.nan)
-        transforms.append(p)
-
-    scale = np.array([p.scale for p in transforms])
-    rotation = np.rad2deg(np.array([p.rotation for p in transforms]))
-    translation = np.array([p.translation for p in transforms])
-    translation = translation * px_angular_size.to('arcsec').value
+    def compute_transforms():
+        ref_img = images[args.ref_image]
+        ref_sources = _rebinned_sources_coordinates(
+            ref_img, args.sep_threshold, args.rebin)
+        if len(ref_sources) < 3:
+            raise Exception('Reference stars in target image are less than '
+                            'the minimum value (3).')
+        chunksize = max(1, len(images) // (4 * os.cpu_count()))
+        with ProcessPoolExecutor(
+                initializer=_init_worker,
+                initargs=(ref_sources, args.sep_threshold, args.rebin),
+                ) as executor:
+            transforms = list(tqdm(
+                executor.map(_fit_one_worker, images, chunksize=chunksize),
+                desc='Aligning images', total=len(images),
+                mininterval=1., miniters=max(1, len(images) // 100),
+                disable=not sys.stderr.isatty()))
+        # gather the transform parameters in a single pass over the list
+        n_transforms = len(transforms)
+        scale = np.empty(n_transforms)
+        rotation = np.empty(n_transforms)
+        translation = np.empty((n_transforms, 2))
+        for i, p in enumerate(transforms):
+            scale[i] = p.scale
+            rotation[i] = p.rotation
+            translation[i] = p.translation
+        return dict(scale=scale, rotation=rotation, translation=translation)
+
+    # re-running with unchanged inputs (eg. to tune the plots) reuses the
+    # transforms cached in {output_path}/.castor_cache
+    try:
+        cache_key = (
+            os.path.getmtime(cube_path), os.path.getsize(cube_path),
+            args.sep_threshold, args.rebin, args.ref_image)
+    except OSError:
+        arrays = compute_transforms()
+    else:
+        cache_dir = os.path.join(args.output_path, '.castor_cache')
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_hash = hashlib.sha1(repr(cache_key).encode()).hexdigest()[:16]
+        cache_path = os.path.join(
+            cache_dir, 'transforms_{}.npz'.format(cache_hash))
+        arrays = files_handling.open_or_compute_npz(
+            cache_path, compute_transforms)
+
+    scale = arrays['scale']
+    rotation = np.rad2deg(arrays['rotation'])
+    translation = arrays['translation'] * px_angular_size.to('arcsec').value
     tx, ty = translation.T
 
     # plots -------------------------------------------------------------------
@@ -143,9 +230,9 @@ def main():
         linestyle='',
         )
     ref_date = timestamps[0]
-    x_label = 'Time since {} [h]'.format(ref_date.strftime('%Y-%m-%d %H:%M:%S'))
-    rel_time = [(ts - ref_date).total_seconds() for ts in timestamps]
-    rel_time = np.array(rel_time) / 3600
+    x_label = 'Time since {} [h]'.format(
+        ref_date.item().strftime('%Y-%m-%d %H:%M:%S'))
+    rel_time = (timestamps - ref_date) / np.timedelta64(1, 'h')
 
     plt.clf()
     plt.plot(rel_time, scale, **style)
@@ -173,22 +260,29 @@ def main():
     plt.xlabel(x_label)
     plt.ylabel('Translation [arcsec]')
     y_fill = np.linspace(*plt.ylim(), 100)
+    # analytic jacobians spare curve_fit one function evaluation per
+    # parameter and LM step (finite differences)
     fit_segments = [
         ('X', tx,
             lambda t, a, b, A, T, φ: a*t + b + A*np.sin(2*np.pi*t/T+φ),
+            lambda t, a, b, A, T, φ: np.column_stack([
+                t, np.ones_like(t), np.sin(2*np.pi*t/T+φ),
+                -A*np.cos(2*np.pi*t/T+φ) * 2*np.pi*t/T**2,
+                A*np.cos(2*np.pi*t/T+φ)]),
             'X(t) = {:.2f} t + {:.1f} + {:.2f} sin(2πt / {:.4f} + {:.1f})',
             (1, 0, 1, .08, 0)),
         ('Y', ty,
             lambda t, a, b: a*t + b,
+            lambda t, a, b: np.column_stack([t, np.ones_like(t)]),
             'Y(t) = {:.2f} t + {:.1f}',
             None),
         ]
     popts, pcovs = [], []
     fit_xdata = rel_time
-    for varname, fx, func, expr, p0 in fit_segments:
+    for varname, fx, func, jac, expr, p0 in fit_segments:
         fit_ydata = fx
         m = ~np.isnan(fit_ydata)
-        popt, pcov = curve_fit(func, fit_xdata[m], fit_ydata[m], p0=p0)
+        popt, pcov = curve_fit(func, fit_xdata[m], fit_ydata[m], p0=p0, jac=jac)
         popts.append(popt)
         pcovs.append(pcov)
         equation = expr.format(*popt)
@@ -30,6 +30,11 @@ def get_parsed_args():
     parser.add_argument(
         '-O', '--overwrite', action='store_true',
         help='Overwrite output if it already exists.')
+    parser.add_argument(
+        '--dtype', type=str, default='float32',
+        choices=['float16', 'float32'],
+        help=('dtype of the prepared cube. float16 halves the memory and '
+              'disk usage, at the cost of precision. Default: float32'))
 
     args = parser.parse_args()
 
@@ -50,6 +55,8 @@ def get_parsed_args():
 def main():
     args = get_parsed_args()
 
+    files_handling.set_float_dtype(args.dtype)
+
     if os.path.exists(args.output) and not args.overwrite:
         msg = "output file '{}' exists, use -O to overwrite it"
         raise OSError(msg.format(args.output))
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import os
 
 from astropy.io import fits
+import numpy as np
 import scipy.ndimage as sndi
 
 from castor import files_handling, preparation, spectroscopy
@@ -54,6 +56,34 @@ def get_parsed_args():
 
     return args
 
+def compute_rotation_angle(master_calib_path, master_calib):
+    ''' Determine the spectrum rotation angle, with an on-disk cache.
+
+    The orientation search (rebin + Radon transform) is expensive; the
+    angle is stored in a .castor_cache/rotation_angle.json next to the
+    master calib, keyed on its path, mtime and size, and reused as long
+    as the master calib is unchanged.
+    '''
+    try:
+        stat = os.stat(master_calib_path)
+        key = [os.path.abspath(master_calib_path), stat.st_mtime, stat.st_size]
+    except FileNotFoundError:
+        return spectroscopy.find_spectrum_orientation(master_calib)
+    cache_dir = os.path.join(os.path.dirname(master_calib_path), '.castor_cache')
+    cache_path = os.path.join(cache_dir, 'rotation_angle.json')
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+        if cache['key'] == key:
+            return cache['angle']
+    except (OSError, ValueError, KeyError):
+        pass
+    angle = spectroscopy.find_spectrum_orientation(master_calib)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path, 'w') as f:
+        json.dump({'key': key, 'angle': float(angle)}, f)
+    return angle
+
 def main():
     args = get_parsed_args()
 
@@ -80,7 +110,7 @@ def main():
         angle = args.spectrum_rotation
         print('Using provided spectrum rotation: {:.2f}°'.format(angle))
     else:
-        angle = spectroscopy.find_spectrum_orientation(master_calib)
+        angle = compute_rotation_angle(args.master_calib, master_calib)
         print('Using computed spectrum rotation: {:.2f}°'.format(angle))
 
     # rotate calib and science spectra ----------------------------------------
@@ -89,13 +119,20 @@ def main():
     files_handling.save_fits(
         master_calib_rotated, args.master_calib_rotated, overwrite=args.overwrite)
 
-    sci_cube_hdulist = fits.open(args.sci_cube)
-    sci_cube = sci_cube_hdulist[args.hdu].data
+    with fits.open(args.sci_cube, memmap=True) as sci_cube_hdulist:
+        sci_cube = sci_cube_hdulist[args.hdu].data
 
-    sci_cube_rotated = sndi.rotate(sci_cube, - angle, axes=(1, 2))
+        # create the output FITS with its final shape, then fill it
+        # slice-by-slice through a memory map, so that neither the input
+        # nor the rotated cube is ever fully held in RAM
+        sample = sndi.rotate(sci_cube[0], - angle)
+        out_shape = (len(sci_cube), *sample.shape)
+        sci_cube_hdulist[args.hdu].data = np.zeros(out_shape, dtype=sample.dtype)
+        sci_cube_hdulist.writeto(args.sci_cube_rotated, overwrite=args.overwrite)
 
-    sci_cube_hdulist[args.hdu].data = sci_cube_rotated
-    sci_cube_hdulist.writeto(args.sci_cube_rotated, overwrite=args.overwrite)
+        with fits.open(args.sci_cube_rotated, mode='update', memmap=True) as out:
+            spectroscopy.rotate_cube(
+                sci_cube, - angle, out=out[args.hdu].data, sample=sample)
 
 
 if __name__ == '__main__':
@@ -54,9 +54,8 @@ def main():
             msg = "output file '{}' exists, use -O to overwrite it"
             raise OSError(msg.format(args.output))
     
-    f = fits.open(args.master_calib_rotated)
-    data = f[0].data
-    Nlam = data.shape[1]
+    with fits.open(args.master_calib_rotated) as f:
+        Nlam = f[0].data.shape[1]
     calib_pts = np.loadtxt(args.calib_points)
     calib_pts[:,0] -= args.start_index  # Re-index the array to start at 0
     calib_array = spectroscopy.calib_wavelength_array(calib_pts, Nlam)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
 import astroalign
@@ -8,14 +9,15 @@ import cv2
 import numpy as np
 
 def affine_transform(img, mat):
-    img_min = np.nanmin(img)
-    img_max = np.nanmax(img)
-    img = (img - img_min) / (img_max - img_min)
+    # cv2 handles float32 data and NaN border values directly, so the
+    # image is warped on its native scale, with no normalise/denormalise
+    # round-trip (four extra full-image passes)
+    img = np.ascontiguousarray(img, dtype=np.float32)
     img_transformed = cv2.warpAffine(
-        img, mat, img.T.shape,
+        img, np.asarray(mat, dtype=np.float32), img.T.shape,
+        borderMode=cv2.BORDER_CONSTANT,
         borderValue=np.nan,
         )
-    img_transformed = img_transformed * (img_max - img_min) + img_min
     return img_transformed
 
 def register_stars(images, ref_img=None):
@@ -44,12 +46,22 @@ def register_stars(images, ref_img=None):
         first_im_is_ref = False
 
     ref_sources = astroalign._find_sources(ref_img)
+    # pass 1: detect the sources of every frame; passing images to
+    # find_transform would re-run this detection on each call, and it
+    # dominates the per-frame cost. sep releases the GIL, so the
+    # detections are overlapped with a thread pool.
+    with ThreadPoolExecutor() as executor:
+        sources = list(tqdm(
+            executor.map(astroalign._find_sources, images),
+            desc='Detecting sources', total=len(images)))
+    # pass 2: fit the transforms from the precomputed source lists and
+    # warp each frame in place
     iterable = tqdm(images, desc='Aligning images', total=len(images))
     for i, img in enumerate(iterable):
         if i == 0 and first_im_is_ref:
             continue
         try:
-            p, _ = astroalign.find_transform(img, ref_sources)
+            p, _ = astroalign.find_transform(sources[i], ref_sources)
             mat = p.params[:-1]
         except Exception as e:
             warnings.warn('Image {}: {}'.format(i, e))
@@ -2,6 +2,7 @@
 
 import sep
 import numpy as np
+from scipy.spatial import cKDTree
 
 def sep_extract(data, threshold=3):
     ''' Extract sources from an image using SEP.
@@ -20,25 +21,64 @@ def sep_extract(data, threshold=3):
         See documentation of sep.extract for a description of the fields.
     '''
     if isinstance(data, np.ma.MaskedArray):
-        image = data.filled(fill_value=np.median(data)).astype(np.float32)
+        # fuse the fill and the cast into a single pass over the data,
+        # instead of materialising a filled copy and then casting it
+        image = np.where(
+            np.ma.getmaskarray(data), np.median(data),
+            data.data).astype(np.float32, copy=False)
     else:
         image = data.astype(np.float32)
     bkg = sep.Background(image)
     thresh = threshold * bkg.globalrms
-    sources = sep.extract(image - bkg.back(), thresh)
+    # subtract the background in place (image is a fresh float32 copy),
+    # instead of materialising bkg.back() and a subtracted image
+    bkg.subfrom(image)
+    sources = sep.extract(image, thresh)
     sources.sort(order='flux')
     # sources = sources.view(np.recarray)
     return sources
 
+def rebin(data, binning):
+    ''' Rebin a 2D image by averaging blocks of binning×binning pixels.
+
+    Parameters
+    ==========
+    data : 2d ndarray
+        The image to rebin.
+    binning : int
+        The size of the averaging blocks. The image is cut to a multiple
+        of binning along each axis.
+
+    Returns
+    =======
+    rebinned : 2d ndarray
+        The rebinned image, of shape (ny // binning, nx // binning).
+    '''
+    binning = int(binning)
+    if binning == 1:
+        return data
+    ny, nx = data.shape
+    ny -= ny % binning
+    nx -= nx % binning
+    shape = (ny // binning, binning, nx // binning, binning)
+    return data[:ny, :nx].reshape(shape).mean(axis=(1, 3))
+
 def sep_sources_coordinates(*args, **kwargs):
     ''' Extract sources coordinates from an image using SEP.
 
     Parameters
     ==========
     *args and **kwarg : passed to sep_extract
+
+    Returns
+    =======
+    coordinates : (n, 2) ndarray
+        The x and y coordinates of the sources, ordered by flux.
     '''
     sources = sep_extract(*args, **kwargs)
-    coordinates = [list(xy) for xy in sources[['x', 'y']]]
+    # a contiguous (n, 2) array, built with two vectorised copies,
+    # instead of one small Python list per source
+    coordinates = np.column_stack((sources['x'], sources['y']))
     return coordinates
 
 def find_closest_sources(catalog, coordinates):
@@ -60,22 +100,13 @@ def find_closest_sources(catalog, coordinates):
         The distances of each returned source to the input coordinate.
     '''
 
-    # compute distance between all input and catalog sources
-    cat_coordinates = np.stack((catalog['x'], catalog['y'])).T
-    cat_coordinates  = cat_coordinates.reshape(-1, 2, 1) # (m, 2, 1)
-    coordinates = np.array(coordinates)
-    coordinates = coordinates.T.reshape(1, 2, -1) # (1, 2, n)
-    dist = np.sum((cat_coordinates - coordinates)**2, axis=1) # (m, n)
-    dist = np.sqrt(dist)
-
-    # find closest sources of catalog
-    i_cat, i_input = np.where(dist == dist.min(axis=0))
-
-    # retrieve coordinates and distance in the correct order
-    sort = np.argsort(i_input)
-    i_cat = i_cat[sort]
-    i_input = i_input[sort]
+    # a k-d tree query runs in O(n log m), without materialising the
+    # (m, n) matrix of all pairwise distances. The x and y fields are
+    # gathered out of the wide SEP records into a contiguous (m, 2)
+    # buffer, which the tree ingests without an internal copy.
+    cat_coordinates = np.column_stack((catalog['x'], catalog['y']))
+    tree = cKDTree(cat_coordinates)
+    dist, i_cat = tree.query(np.asarray(coordinates), k=1)
     filtered_catalog = catalog[i_cat]
-    dist = dist[(i_cat, i_input)]
 
     return filtered_catalog, dist
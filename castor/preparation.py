@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
+from astropy.io import fits
 from tqdm import tqdm
 import numpy as np
 
@@ -38,13 +40,43 @@ def create_master(filenames, default=None):
             return default
         else:
             raise ValueError('{} is empty'.format(empty_name))
-    master = np.zeros_like(files_handling.load_fits_data(filenames[0]))
+    # accumulate in float64, normalising each frame into a reused scratch
+    # buffer, instead of allocating a fresh normalised copy per file
+    master = None
     for filename in filenames:
-        master += files_handling.load_fits_data(filename)
-    master = master / len(filenames)
-    return master
+        with fits.open(filename) as f:
+            data = f[0].data
+            inv_exptime = 1. / f[0].header['EXPTIME']
+            if master is None:
+                master = np.zeros(data.shape, dtype=np.float64)
+                frame = np.empty(data.shape, dtype=np.float64)
+            np.multiply(data, inv_exptime, out=frame)
+            master += frame
+    master /= len(filenames)
+    return master.astype(files_handling.FLOAT_DTYPE)
 
-def prepare(sci_dir, sci_dark_dir, flat_dir, flat_dark_dir):
+def prepare(sci_dir, sci_dark_dir, flat_dir, flat_dark_dir,
+            memmap_path=None):
+    ''' Open, sort, and calibrate (dark and flat) a directory of science
+    FITS.
+
+    Parameters
+    ==========
+    sci_dir, sci_dark_dir, flat_dir, flat_dark_dir : str
+        Directories containing the science, science dark, flat, and flat
+        dark FITS files.
+    memmap_path : str or None (default: None)
+        If given, back the prepared cube with a numpy memmap at this
+        path instead of allocating it in RAM, enabling observation runs
+        larger than memory (pages are spilled to disk under pressure).
+
+    Returns
+    =======
+    sci_images : 3D ndarray
+        The calibrated science images, sorted by DATE-OBS.
+    timestamps : ndarray of datetime64
+        The corresponding timestamps.
+    '''
     master_sci_dark = create_master(sci_dark_dir, default=0)
     master_flat_dark = create_master(flat_dark_dir, default=0)
     master_flat = create_master(flat_dir, default=1)
@@ -57,15 +89,35 @@ def prepare(sci_dir, sci_dark_dir, flat_dir, flat_dark_dir):
 
     # sort images with DATE-OBS
     timestamps = files_handling.get_timestamps(sci_filenames)
-    sci_order = np.argsort(timestamps)
+    sci_order = np.argsort(timestamps, kind='stable')
     timestamps = timestamps[sci_order]
-    sci_filenames = np.array(sci_filenames)[sci_order]
+    # reorder the filename list directly instead of boxing the strings
+    # into an object ndarray just to fancy-index it
+    sci_filenames = [sci_filenames[i] for i in sci_order.tolist()]
 
     # open sci data
     n_files = len(sci_filenames)
     sample_data = files_handling.load_fits_data(sci_filenames[0])
-    sci_images = np.zeros((n_files, *sample_data.shape), dtype=sample_data.dtype)
-    for i, sci_filename in enumerate(tqdm(sci_filenames, desc='Opening FITS')):
-        sci = files_handling.load_fits_data(sci_filename)
-        sci_images[i] = (sci - master_sci_dark) / master_flat
+    if memmap_path is not None:
+        sci_images = np.memmap(
+            memmap_path, dtype=sample_data.dtype, mode='w+',
+            shape=(n_files, *sample_data.shape))
+    else:
+        sci_images = np.zeros(
+            (n_files, *sample_data.shape), dtype=sample_data.dtype)
+    # the per-file load + calibration is I/O and memory-bandwidth bound
+    # and releases the GIL, so overlap the files with a thread pool, each
+    # worker writing its frame into the preallocated cube
+    def load_one(i):
+        sci = files_handling.load_fits_data(sci_filenames[i])
+        # calibrate without a temporary per step: the subtraction mutates
+        # the freshly-loaded frame, the division writes into the cube
+        np.subtract(sci, master_sci_dark, out=sci)
+        np.divide(sci, master_flat, out=sci_images[i])
+    with ThreadPoolExecutor() as executor:
+        list(tqdm(
+            executor.map(load_one, range(n_files)),
+            desc='Opening FITS', total=n_files))
+    if memmap_path is not None:
+        sci_images.flush()
     return sci_images, timestamps
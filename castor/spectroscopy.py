@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import scipy.interpolate as sinterp
+import scipy.ndimage as sndi
 from scipy.signal import fftconvolve
 import skimage.transform as skt
 from scipy.optimize import curve_fit
@@ -83,6 +87,52 @@ def find_spectrum_orientation(spectrum, angle_step=.25):
     angle = angles[np.argmax(spectrum_rt_max)]
     return angle
 
+def rotate_cube(cube, angle, out=None, sample=None):
+    ''' Rotate each frame of a cube of 2D spectra.
+
+    The frames are independent, so the per-frame rotations are dispatched
+    to a thread pool (scipy.ndimage releases the GIL) and written into a
+    preallocated output, instead of rotating the full 3D cube in a single
+    scipy.ndimage.rotate call.
+
+    Parameters
+    ==========
+    cube : 3D ndarray
+        The array of 2D spectra (images) to rotate.
+    angle : float
+        The rotation angle, in degrees.
+    out : 3D ndarray or None (default: None)
+        Array receiving the rotated frames (eg. the memory-mapped data of
+        a FITS opened in update mode, so that frames are streamed to disk
+        instead of being held in RAM). Its shape must match the rotated
+        cube shape, which can be determined by rotating a single frame.
+        If None, a new array is allocated.
+    sample : 2D ndarray or None (default: None)
+        The already-rotated first frame, if the caller rotated it to
+        determine the output shape; passing it avoids rotating that
+        frame a second time.
+
+    Returns
+    =======
+    cube_rotated : 3D ndarray
+        The cube of rotated 2D spectra (`out` if it was provided).
+    '''
+    if sample is None:
+        # rotate the first frame to determine the output frame shape
+        sample = sndi.rotate(cube[0], angle)
+    if out is None:
+        cube_rotated = np.empty((len(cube), *sample.shape), dtype=sample.dtype)
+    else:
+        cube_rotated = out
+    cube_rotated[0] = sample
+    def rotate_frame(i):
+        cube_rotated[i] = sndi.rotate(cube[i], angle)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(tqdm(
+            executor.map(rotate_frame, range(1, len(cube))),
+            desc='Rotating images', total=len(cube) - 1))
+    return cube_rotated
+
 def calib_wavelength_array(calib_pts, Nlam):
     '''Generate an array of the pixel index - wavelength correspondence,
     from an linear fit of some (pixel_index, associated wavelenth) tuple.
@@ -137,7 +187,7 @@ def cross_correlation(img1, img2):
     return x_dith, y_dith
 
 def align_images(Img, img_ref=0, xaxis=True, yaxis=True, 
-                 gauss=True, sigma=0.5):
+                 gauss=True, sigma=0.5, allocate=np.zeros):
     '''Align a series of image relatively to the img_ref,
     along the x and y-axis.
 
@@ -156,6 +206,12 @@ def align_images(Img, img_ref=0, xaxis=True, yaxis=True,
         to reduce the effects of sharpy edges.
     sigma : float (default : 0.5)
         If gauss=True, the standard deviation of the use gaussian.
+    allocate : callable (default: np.zeros)
+        Called with the output shape to allocate the aligned cube, once
+        the shifts (and thus the new dimensions) are known. Callers can
+        pass a function returning eg. the memory-mapped data of a FITS
+        opened in update mode, so that aligned frames are streamed to
+        disk instead of being held in RAM. It must return a zeroed array.
 
     Returns
     =======
@@ -170,11 +226,14 @@ def align_images(Img, img_ref=0, xaxis=True, yaxis=True,
         G = gauss2d(X, Y, 1, 0, 0, sigma, sigma)
         for i in range(N):
             Img2 *= G
-    # Shift determination using FFT convolution
+    # Shift determination using FFT convolution, with the per-frame
+    # correlations dispatched to a thread pool (the FFTs release the GIL)
     ref = Img2[img_ref]
     x_dith, y_dith = np.zeros(N, dtype=int), np.zeros(N, dtype=int)
-    for i in tqdm(range(N)):
+    def compute_shift(i):
         x_dith[i], y_dith[i] = cross_correlation(ref, Img2[i])
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(tqdm(executor.map(compute_shift, range(N)), total=N))
     if not xaxis:
         x_dith[:] = 0
     if not yaxis:
@@ -184,7 +243,7 @@ def align_images(Img, img_ref=0, xaxis=True, yaxis=True,
     y0 = np.max(np.abs(y_dith))
     Xnew = Xsize + 2*x0
     Ynew = Ysize + 2*y0
-    Img_align = np.zeros((N, Ynew, Xnew))
+    Img_align = allocate((N, Ynew, Xnew))
     # Alignement
     for i in range(N):
         Img_align[i, y0+y_dith[i]:y0+Ysize+y_dith[i], x0+x_dith[i]:x0+Xsize+x_dith[i]] = Img[i]